@@ -1,21 +1,181 @@
 from lxml import etree
-from datetime import datetime, timedelta, time, timezone
-import json
-import requests
-import pytz
-import math
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime, timedelta, time, timezone
+from zoneinfo import ZoneInfo
+import asyncio
+import aiohttp
+import ciso8601
+import functools
+import multiprocessing
+import orjson
 import re
+import threading
 import unicodedata
-from bs4 import BeautifulSoup
+from lxml import html as lhtml
+from lxml.cssselect import CSSSelector
 
 bt_dt_format = '%Y-%m-%dT%H:%M:%SZ'
-tz = pytz.timezone('Europe/London')
+xmltv_dt_format = '%Y%m%d%H%M%S %z'
+tz = ZoneInfo('Europe/London')
+
+# API endpoints for each source, filled in with str.format
+sky_url_template = "https://epgservices.sky.com/5.2.2/api/2.0/channel/json/{sid}/{epoch}/86400/4"
+sky_icon_prefix = "http://epgstatic.sky.com/epgdata/1.0/paimage/46/1/"
+bt_url_template = "https://voila.metabroadcast.com/4/schedules/{sid}.json?key=b4d2edb68da14dfb9e47b5465e99b1b1" \
+                  "&from={start}&to={end}&source=api.youview.tv&annotations=content.description"
+bbc_url_template = "https://www.bbc.co.uk/sounds/schedules/{sid}/{date}"
+freeview_guide_url = "https://www.freeview.co.uk/api/tv-guide"
+freeview_info_url_template = "https://www.freeview.co.uk/api/program?sid={sid}&nid={nid}&pid={pid}" \
+                             "&start_time={start_time}&duration={duration}"
+
+# Maximum number of requests in flight to each source's API at once
+source_limits = {"sky": 16, "bt": 8, "bbc_radio": 8, "freeview": 16}
+# Server errors are retried, waiting retry_backoff * 2^attempt seconds in between
+max_retries = 3
+retry_backoff = 0.5
+# Idle connections are kept open this long (seconds) so later requests to the same host can reuse them
+keepalive_timeout = 30
+# Per-socket limits (seconds) rather than an overall one, so time spent queued for a pooled connection doesn't count
+connect_timeout = 30
+read_timeout = 60
+session_headers = {"User-Agent": "freeview-epg (+https://github.com/ExperiencersInternational/Freeview-EPG)"}
+
+# Parsers and selectors for BBC Sounds schedule pages, built once rather than per page. lxml locks a parser while it's
+# in use, so each thread gets its own parser to let pages parse in parallel
+html_parsers = threading.local()
+bbc_section_selector = CSSSelector("section.sc-c-schedule-segment")
+bbc_item_selector = CSSSelector(r"div.sc-c-schedule-item.gs-u-display-block.gs-u-mb.gs-u-mb\+\@m.gs-u-pv\+")
+bbc_air_time_selector = CSSSelector("p.sc-c-schedule-item__on-air-time.gel-great-primer")
+bbc_info_selector = CSSSelector("div.gs-u-display-flex.sc-u-flex-column")
+
+# Executor that CPU-bound page parsing is handed to. Set to a process pool when run as a script; left as None, the
+# default thread pool is used instead, where each thread's own parser can parse pages with the GIL released
+parse_pool = None
+
+
+@dataclass(slots=True)
+class Channel:
+    """
+A channel from freeview_channels.xml
+    """
+    source: str
+    id: str
+    name: str
+    sid: str
+    nid: str | None = None
+    lang: str = 'en'
+
+
+@dataclass(slots=True)
+class Programme:
+    """
+A single programme to be written to the XMLTV file
+    """
+    title: str
+    description: str | None
+    start: float
+    stop: float
+    icon: str | None
+    channel: str
+
 
 # From https://stackoverflow.com/questions/4324790/removing-control-characters-from-a-string-in-python, and the original Freeview-EPG project, didn't merge commits from there since I want to keep the BBC Radio source in the code for now
+class ControlCharacterTable(dict):
+    """
+Translation table for str.translate that drops control characters. Building the table for every code point up
+front costs over a second, so each code point is looked up the first time it's seen and remembered
+    """
+    def __missing__(self, codepoint):
+        self[codepoint] = None if unicodedata.category(chr(codepoint))[0] == "C" else codepoint
+        return self[codepoint]
+
+
+control_character_table = ControlCharacterTable()
+
+
 def remove_control_characters(s):
-    return "".join(ch for ch in s if unicodedata.category(ch)[0]!="C")
+    # Printable strings can't contain control characters, so most descriptions skip the translate entirely
+    if s.isprintable():
+        return s
+    return s.translate(control_character_table)
+
+@functools.lru_cache(maxsize=4096)
+def parse_bt_time(timestamp: str) -> int:
+    """
+Convert a BT transmission time into an epoch time. Adjacent programmes share a boundary, so these are cached
+    :param timestamp: The UTC timestamp as given by the API
+    :return: Epoch time
+    """
+    try:
+        return int(ciso8601.parse_datetime(timestamp).timestamp())
+    except ValueError:
+        return int(datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S.000Z").replace(tzinfo=timezone.utc).timestamp())
+
+
+@functools.lru_cache(maxsize=4096)
+def parse_freeview_time(timestamp: str) -> datetime:
+    """
+Convert a Freeview start time into a datetime. Adjacent programmes share a boundary, so these are cached
+    :param timestamp: The timestamp, with offset, as given by the API
+    :return: Timezone-aware datetime
+    """
+    try:
+        return ciso8601.parse_datetime(timestamp)
+    except ValueError:
+        return datetime.strptime(timestamp, "%Y-%m-%dT%H:%M:%S%z")
+
 
 # From spatialtime/iso8601_duration.py
+iso_duration_re = re.compile(r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:.\d+)?)S)?$')
+
+
+def scan_duration(iso_duration):
+    """Parses the common PnDTnHnMnS form of an ISO 8601 duration without a regex.
+    Args:
+        iso_duration: an ISO 8601 duration string.
+    Returns:
+        a datetime.timedelta instance, or None if the string needs the full parser
+    """
+    if not iso_duration.startswith('P'):
+        return None
+
+    # Days are the only date designator handled here; hours, minutes and seconds must come after 'T', in that order.
+    # Anything else (years, months, stray characters) is left to the regex
+    seen_t = False
+    allowed = 'D'
+    values = {}
+    number = ''
+
+    for ch in iso_duration[1:]:
+        if ch.isdecimal() or ch == '.':
+            number += ch
+        elif ch == 'T' and not seen_t and not number:
+            seen_t = True
+            allowed = 'HMS'
+        elif ch in allowed and number:
+            # Only seconds may have a fractional part
+            whole, _, fraction = number.partition('.') if ch == 'S' else (number, '', '')
+            if not whole.isdecimal() or (fraction and not fraction.isdecimal()) or number.endswith('.'):
+                return None
+            values[ch] = number
+            allowed = allowed[allowed.index(ch) + 1:]
+            number = ''
+        else:
+            return None
+
+    if number or not seen_t:
+        return None
+
+    days = int(values.get('D', 0))
+    hours = int(values.get('H', 0))
+    minutes = int(values.get('M', 0))
+    seconds = float(values.get('S', 0))
+
+    return timedelta(days=days, hours=hours, minutes=minutes, seconds=seconds)
+
+
+@functools.lru_cache(maxsize=512)
 def parse_duration(iso_duration):
     """Parses an ISO 8601 duration string into a datetime.timedelta instance.
     Args:
@@ -23,8 +183,11 @@ def parse_duration(iso_duration):
     Returns:
         a datetime.timedelta instance
     """
-    m = re.match(r'^P(?:(\d+)Y)?(?:(\d+)M)?(?:(\d+)D)?T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+(?:.\d+)?)S)?$',
-                 iso_duration)
+    duration = scan_duration(iso_duration)
+    if duration is not None:
+        return duration
+
+    m = iso_duration_re.match(iso_duration)
     if m is None:
         raise ValueError("invalid ISO 8601 duration string")
 
@@ -55,306 +218,479 @@ def get_days(src: str) -> list:
 Generate epoch times for now, midnight tomorrow, and midnight the next day
     :return: List of times, either in epoch (for Sky) or str (for BT)
     """
+    # Only read the clock once, so midnight can't tick over between the times being calculated
+    now_local = datetime.now()
+    midnight = datetime.combine(now_local, time(0, 0))
+
     if src == "sky":
-        now = int(datetime.timestamp(datetime.now() - timedelta(hours=1)))
-        day_1 = int(datetime.timestamp(datetime.combine(datetime.now(), time(0, 0)) + timedelta(1)))
-        day_2 = int(datetime.timestamp(datetime.combine(datetime.now(), time(0, 0)) + timedelta(2)))
+        now = int(datetime.timestamp(now_local - timedelta(hours=1)))
+        day_1 = int(datetime.timestamp(midnight + timedelta(1)))
+        day_2 = int(datetime.timestamp(midnight + timedelta(2)))
         return [now, day_1, day_2]
 
     elif src == "bt":
-        now = datetime.now() - timedelta(hours=1)
-        day_1 = (datetime.combine(datetime.now(), time(0, 0)) + timedelta(1))
-        day_2 = (datetime.combine(datetime.now(), time(0, 0)) + timedelta(2))
+        now = now_local - timedelta(hours=1)
+        day_1 = midnight + timedelta(1)
+        day_2 = midnight + timedelta(2)
         return [now, day_1, day_2]
 
     elif src == "freeview":
-        midnight = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp()
+        # Epoch time has no leap seconds or DST, so UTC midnight is just the epoch rounded down to whole days
+        utc_midnight = int(now_local.timestamp()) // 86400 * 86400
 
-        now = math.trunc(datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).timestamp())
-        day_1 = math.trunc((datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(1)).timestamp())
-        day_2 = math.trunc((datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(2)).timestamp())
-        return [now, day_1, day_2]
+        return [utc_midnight, utc_midnight + 86400, utc_midnight + 2 * 86400]
 
     else:
-        now = (datetime.combine(datetime.now(), time(0, 0)))
-        day_1 = (datetime.combine(datetime.now(), time(0, 0)) + timedelta(1))
-        day_2 = (datetime.combine(datetime.now(), time(0, 0)) + timedelta(2))
+        now = midnight
+        day_1 = midnight + timedelta(1)
+        day_2 = midnight + timedelta(2)
         return [now, day_1, day_2]
 
 
 def get_channels_data() -> list:
     """
 Load XML file of channel information
-    :return: XML elements as a set, then all sets as a list
+    :return: List of channels
     """
     data_list = []
-    x = etree.parse('freeview_channels.xml')
-    data = x.find('channels').getchildren()
-
-    for element in data:
-        if element.items() is not None:
-            items = element.items()
-            items.append(('name', element.text))
-            data_list.append(items)
+    for _, element in etree.iterparse('freeview_channels.xml', tag='channel'):
+        attrs = element.attrib
+        data_list.append(Channel(source=attrs['src'], id=attrs['xmltv_id'], name=element.text, sid=attrs['site_id'],
+                                 nid=attrs.get('nid'), lang=attrs.get('lang', 'en')))
+        element.clear()
 
     return data_list
 
 
-def build_xmltv(channels: list, programmes: list) -> bytes:
+@functools.lru_cache(maxsize=8192)
+def format_xmltv_time(timestamp: float) -> str:
+    """
+Format an epoch time for XMLTV. Programmes share start/stop times with their neighbours, so these are cached
+    :param timestamp: Epoch time
+    :return: Local time, with offset since UK has daylight savings
+    """
+    return datetime.fromtimestamp(timestamp, tz).strftime(xmltv_dt_format)
+
+
+def write_xmltv(path: str, channels: list, programmes: list):
     """
-Make the channels and programmes into something readable by XMLTV
+Make the channels and programmes into something readable by XMLTV, writing them out as they're generated rather
+than building the whole tree in memory first
+    :param path: Where to write the XML file
     :param channels: The list of channels to be generated
     :param programmes: The list of programmes to be generated
-    :return: A sequence of bytes for XML
-    """
-    # Timezones since UK has daylight savings
-    dt_format = '%Y%m%d%H%M%S %z'
-
-    data = etree.Element("tv")
-    data.set("generator-info-name", "freeview-epg")
-    data.set("generator-info-url", "https://github.com/ExperiencersInternational/Freeview-EPG")
-    for ch in channels:
-        channel = etree.SubElement(data, "channel")
-        channel.set("id", ch[2][1])
-        name = etree.SubElement(channel, "display-name")
-        name.set("lang", "en")
-        name.text = ch[4][1]
-
-    for pr in programmes:
-        programme = etree.SubElement(data, 'programme')
-        start_time = datetime.fromtimestamp(pr.get('start'), tz).strftime(dt_format)
-        end_time = datetime.fromtimestamp(pr.get('stop'), tz).strftime(dt_format)
-
-        programme.set("channel", pr.get('channel'))
-        programme.set("start", start_time)
-        programme.set("stop", end_time)
-
-        title = etree.SubElement(programme, "title")
-        title.set('lang', 'en')
-        title.text = pr.get("title")
-
-        if pr.get('description') is not None:
-            description = etree.SubElement(programme, "desc")
-            description.set('lang', 'en')
-            description.text = remove_control_characters(pr.get("description"))
-
-        if pr.get('icon') is not None:
-            icon = etree.SubElement(programme, "icon")
-            icon.set('src', pr.get("icon"))
-
-    return etree.tostring(data, pretty_print=True, encoding='utf-8')
-
-
-# Load the channels data
-channels_data = get_channels_data()
-
-programme_data = []
-for channel in channels_data:
-    print(channel[2][1])
-    # If EPG is to be sourced from Sky:
-    if channel[0][1] == "sky":
-        # Get some epoch times - right now, 12am tomorrow and 12am the day after tomorrow (so 48h)
-        epoch_times = get_days(channel[0][1])
-        for epoch in epoch_times:
-            url = f"https://epgservices.sky.com/5.2.2/api/2.0/channel/json/{channel[3][1]}/{epoch}/86400/4"
-            req = requests.get(url)
-            if req.status_code != 200:
-                continue
-            result = json.loads(req.text)
-            epg_data = result['listings'][f'{channel[3][1]}']
-            for item in epg_data:
-                title = item['t']
-                desc = item['d'] if 'd' in item else None
-                start = int(item['s'])
-                end = int(item['s']) + int(item['m'][1])
-                icon = f"http://epgstatic.sky.com/epgdata/1.0/paimage/46/1/{item['img']}" if 'img' in item else None
-                ch_name = channel[2][1]
-
-                programme_data.append({
-                    "title": title,
-                    "description": desc,
-                    "start": start,
-                    "stop": end,
-                    "icon": icon,
-                    "channel": ch_name
-                })
-
-    # If EPG is from BT TV:
-    if channel[0][1] == "bt":
-        times = get_days(channel[0][1])
-        for t in times:
-            url = f'https://voila.metabroadcast.com/4/schedules/{channel[3][1]}.json?key=b4d2edb68da14dfb9e47b5465e99b1b1&from={t.strftime(bt_dt_format)}&to={(datetime.combine(t, time(0, 0)) + timedelta(1)).strftime(bt_dt_format)}&source=api.youview.tv&annotations=content.description'
-            req = requests.get(url)
-            if req.status_code != 200:
-                continue
-            result = json.loads(req.text)
-            epg_data = []
-            for x in result['schedule']['entries']:
-                title = x.get('item').get('display_title').get('title').strip()
-                desc = x.get('item').get('description').strip()
-                start = int(tz.fromutc(datetime.strptime(x.get('broadcast').get('transmission_time'),
-                                                         "%Y-%m-%dT%H:%M:%S.000Z")).timestamp())
-                end = int(tz.fromutc(datetime.strptime(x.get('broadcast').get('transmission_end_time'),
-                                                       "%Y-%m-%dT%H:%M:%S.000Z")).timestamp())
-                icon = x.get('item').get('image')
-                ch_name = channel[2][1]
-
-                programme_data.append({
-                    "title": title,
-                    "description": desc,
-                    "start": start,
-                    "stop": end,
-                    "icon": icon,
-                    "channel": ch_name
-                })
-
-    # If EPG is a BBC radio station
-    if channel[0][1] == "bbc_radio":
-        url_list = [f'https://www.bbc.co.uk/sounds/schedules/{channel[3][1]}/{d.date()}' for d in get_days("bbc_radio")]
-        for url in url_list:
-            current_date = datetime.strptime(url.split('/')[-1], "%Y-%m-%d").date()
-            response = requests.get(url)
-            if response.status_code != 200:
-                continue
-            soup = BeautifulSoup(response.content, features="html.parser")
-            soup.prettify()
-
-            # Get the schedule sections (early, morning, afternoon, evening, late)
-            sections = soup.find_all("section", {"class": "sc-c-schedule-segment"})
-            for s_idx, section in enumerate(sections):
-                # Find each programme item as a block on the schedule
-                programme_items = section.find_all("div", {
-                    "class": "sc-c-schedule-item gs-u-display-block gs-u-mb gs-u-mb+@m gs-u-pv+"})
-                print(f"Total items in section {s_idx}: {len(programme_items)}")
-                for p_idx, item in enumerate(programme_items):
-                    # Get the air time from the block. We only want shows from 00:00:00 to 23:59:59 for each page,
-                    # so get rid of shows that start on the day before or day after
-                    air_time = datetime.strptime(
-                        item.find("p", {"class": "sc-c-schedule-item__on-air-time gel-great-primer"}).text,
-                        "%H:%M").time()
-                    if section.attrs.get("aria-labelledby") == "early":
-                        if air_time >= time(7, 0, 0):
-                            continue
-                    if section.attrs.get("aria-labelledby") == "late":
-                        if air_time > time(0, 30, 0):
-                            continue
-
-                    # Dive further into each item to extract info correctly
-                    programme_thumbnail = item.find("img")['src']
-                    info = item.find("div", {"class": "gs-u-display-flex sc-u-flex-column"}).contents[0]
-                    programme_name = info.contents[0].text
-                    programme_desc = info.contents[2].text
-                    programme_start = datetime.combine(current_date, air_time)
-                    if section.attrs.get("aria-labelledby") == "late":
-                        if programme_start.time() > time(0, 30, 0):
-                            continue
-                    ch_name = channel[2][1]
-                    q = len(programme_items)
-                    # If we're still within the same section (as in, we haven't run out of programmes in the list), get
-                    # the next programme's start time from the next item in the list
-                    try:
-                        if p_idx <= len(programme_items):
-                            next_idx = p_idx + 1
-                            next_start = datetime.strptime(programme_items[next_idx].find("p", {
-                                "class": "sc-c-schedule-item__on-air-time gel-great-primer"}).text, "%H:%M").time()
-                    except IndexError as ex:
-                        # However, if we have run out of programmes, but not run out of sections, then find the next
-                        # start time from first programme block in the next section
-                        if s_idx + 1 < len(sections):
-                            next_idx = s_idx + 1
-                            next_start = datetime.strptime(sections[next_idx].find("div", {
-                                "class": "sc-c-schedule-item gs-u-display-block gs-u-mb gs-u-mb+@m gs-u-pv+"}).find("p", {
-                                "class": "sc-c-schedule-item__on-air-time gel-great-primer"}).text, "%H:%M").time()
-
-                    print(f"\nName: {programme_name}, Loc: S{s_idx}P{p_idx}")
-                    if s_idx == 3 and p_idx == len(programme_items) - 1:
-                        programme_stop = datetime.combine(programme_start.date() + timedelta(days=1), next_start)
-                    elif s_idx == 4:
-                        if len(programme_items) == 1 or p_idx == len(programme_items) - 1:
-                            continue
-                        else:
-                            programme_start = datetime.combine(programme_start.date() + timedelta(days=1), air_time)
-                            programme_stop = datetime.combine(programme_start.date(), next_start)
-                    else:
-                        programme_stop = datetime.combine(programme_start, next_start)
-                    print(f"On: {programme_start} - {programme_stop}\n")
-
-                    programme_data.append({
-                        "title": programme_name,
-                        "description": programme_desc,
-                        "start": programme_start.timestamp(),
-                        "stop": programme_stop.timestamp(),
-                        "icon": programme_thumbnail,
-                        "channel": ch_name
-                    })
-
-if channel[0][1] == "freeview":
-        epoch_times = get_days("freeview")
-        for epoch in epoch_times:
-            # Get programme data for Freeview multiplex
-            url = f"https://www.freeview.co.uk/api/tv-guide"
-            req = requests.get(url, params={'nid': f'{channel[4][1]}', 'start': f'{str(epoch)}'})
-            if req.status_code != 200:
-                continue
-            result = json.loads(req.text)
-            epg_data = result['data']['programs']
-
-            ch_match = filter(lambda ch: ch['service_id'] == channel[3][1], epg_data)
-
-            # For each channel in result, get UID from JSON
-            for item in ch_match:
-                service_id = item.get('service_id')
-
-                # Freeview API returns basic info with EPG API call
-                for listing in item.get('events'):
-
-                    ch_name = channel[2][1]
-                    title = listing.get("main_title")
-                    desc = listing.get("secondary_title") if "secondary_title" in listing else \
-                        "No further information..."
-                    temp_start = datetime.strptime(listing.get('start_time'), "%Y-%m-%dT%H:%M:%S%z")
-                    duration = parse_duration(listing.get('duration'))
-                    end = (temp_start + duration).timestamp()
-                    start = temp_start.timestamp()
-
-                    # There's another URL for more in-depth programme information
-                    data_url = f"https://www.freeview.co.uk/api/program?sid={service_id}&nid={channel[4][1]}" \
-                               f"&pid={listing.get('program_id')}&start_time={listing.get('start_time')}&duration={listing.get('duration')}"
-                    info_req = requests.get(data_url)
-
-                    try:
-                        res = json.loads(info_req.text)
-                    except Exception as ex:
-                        continue
-
-                    # Should only return one programme, so just get the first if one exists
-                    info = res['data']['programs'][0] if 'programs' in res['data'] else None
-
-                    # Update the description with Freeview Play's medium option if available
-                    desc = info.get('synopsis').get('medium') if 'synopsis' in info else ''
-
-                    # Get Freeview Play's image, or use the fallback
-                    if 'image_url' in info:
-                        icon = info.get('image_url') + '?w=800'
-                    elif 'fallback_image_url' in listing:
-                        icon = listing.get('fallback_image_url') + '?w=800'
-                    else:
-                        icon = None
-
-                    print(f"Title: {title} @ {temp_start}")
-
-                    programme_data.append({
-                        "title":       title,
-                        "description": desc,
-                        "start":       start,
-                        "stop":        end,
-                        "icon":        icon,
-                        "channel":     ch_name
-                    })
-
-channel_xml = build_xmltv(channels_data, programme_data)
-
-# Write some XML
-with open('epg.xml', 'wb') as f:
-    f.write(channel_xml)
-    f.close()
+    """
+    with open(path, 'wb') as f:
+        with etree.xmlfile(f, encoding='utf-8') as xf:
+            with xf.element("tv", {"generator-info-name": "freeview-epg",
+                                   "generator-info-url": "https://github.com/ExperiencersInternational/Freeview-EPG"}):
+                for ch in channels:
+                    xf.write("\n  ")
+                    with xf.element("channel", id=ch.id):
+                        xf.write("\n    ")
+                        with xf.element("display-name", lang=ch.lang):
+                            xf.write(ch.name)
+                        xf.write("\n  ")
+
+                for pr in programmes:
+                    xf.write("\n  ")
+                    with xf.element("programme", {"channel": pr.channel, "start": format_xmltv_time(pr.start),
+                                                  "stop": format_xmltv_time(pr.stop)}):
+                        xf.write("\n    ")
+                        with xf.element("title", lang="en"):
+                            xf.write(pr.title)
+
+                        if pr.description is not None:
+                            xf.write("\n    ")
+                            with xf.element("desc", lang="en"):
+                                xf.write(remove_control_characters(pr.description))
+
+                        if pr.icon is not None:
+                            xf.write("\n    ")
+                            xf.write(etree.Element("icon", src=pr.icon))
+                        xf.write("\n  ")
+                xf.write("\n")
+        # Finish with a newline after the root element, like pretty-printed output
+        f.write(b"\n")
+
+
+async def request(session: aiohttp.ClientSession, sem: asyncio.Semaphore, url: str, params: dict = None,
+                  as_json: bool = True):
+    """
+Request a URL, retrying server errors with exponential backoff
+    :param session: The shared HTTP session
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :param url: The URL to be requested
+    :param params: Any query string parameters for the request
+    :param as_json: Whether to decode the response as JSON, or return the raw body
+    :return: The response, or None if the request was unsuccessful
+    """
+    for attempt in range(max_retries + 1):
+        async with sem:
+            try:
+                async with session.get(url, params=params) as resp:
+                    if resp.status == 200:
+                        body = await resp.read()
+                        if not as_json:
+                            return body
+                        try:
+                            return orjson.loads(body)
+                        except ValueError as ex:
+                            print(f"Giving up on {url}: invalid JSON ({ex})")
+                            return None
+                    if resp.status < 500:
+                        return None
+            except (aiohttp.ClientError, asyncio.TimeoutError) as ex:
+                if attempt == max_retries:
+                    print(f"Giving up on {url}: {ex!r}")
+                    return None
+        if attempt < max_retries:
+            await asyncio.sleep(retry_backoff * 2 ** attempt)
+
+    print(f"Giving up on {url}: server error after {max_retries + 1} attempts")
+    return None
+
+
+async def get_json(session: aiohttp.ClientSession, sem: asyncio.Semaphore, url: str, params: dict = None):
+    """
+Request a URL and decode the response as JSON
+    :param session: The shared HTTP session
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :param url: The URL to be requested
+    :param params: Any query string parameters for the request
+    :return: The decoded JSON, or None if the request was unsuccessful
+    """
+    return await request(session, sem, url, params)
+
+
+async def get_content(session: aiohttp.ClientSession, sem: asyncio.Semaphore, url: str, params: dict = None):
+    """
+Request a URL and return the raw response body
+    :param session: The shared HTTP session
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :param url: The URL to be requested
+    :param params: Any query string parameters for the request
+    :return: The response body as bytes, or None if the request was unsuccessful
+    """
+    return await request(session, sem, url, params, as_json=False)
+
+
+async def fetch_sky(session: aiohttp.ClientSession, channel: Channel, sem: asyncio.Semaphore) -> list:
+    """
+Get the programmes for a channel sourced from Sky
+    :param session: The shared HTTP session
+    :param channel: The channel to be fetched
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :return: List of programmes
+    """
+    programmes = []
+    # Get some epoch times - right now, 12am tomorrow and 12am the day after tomorrow (so 48h)
+    epoch_times = get_days(channel.source)
+    urls = [sky_url_template.format(sid=channel.sid, epoch=epoch) for epoch in epoch_times]
+    results = await asyncio.gather(*(get_json(session, sem, url) for url in urls))
+    for result in results:
+        if result is None:
+            continue
+        epg_data = result['listings'][f'{channel.sid}']
+        for item in epg_data:
+            title = item['t']
+            desc = item['d'] if 'd' in item else None
+            start = int(item['s'])
+            end = int(item['s']) + int(item['m'][1])
+            icon = sky_icon_prefix + item['img'] if 'img' in item else None
+            ch_name = channel.id
+
+            programmes.append(Programme(title=title, description=desc, start=start, stop=end, icon=icon,
+                                        channel=ch_name))
+
+    return programmes
+
+
+async def fetch_bt(session: aiohttp.ClientSession, channel: Channel, sem: asyncio.Semaphore) -> list:
+    """
+Get the programmes for a channel sourced from BT TV
+    :param session: The shared HTTP session
+    :param channel: The channel to be fetched
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :return: List of programmes
+    """
+    programmes = []
+    times = get_days(channel.source)
+    urls = [bt_url_template.format(sid=channel.sid, start=t.strftime(bt_dt_format),
+                                   end=(datetime.combine(t, time(0, 0)) + timedelta(1)).strftime(bt_dt_format))
+            for t in times]
+    results = await asyncio.gather(*(get_json(session, sem, url) for url in urls))
+    for result in results:
+        if result is None:
+            continue
+        for x in result['schedule']['entries']:
+            title = x.get('item').get('display_title').get('title').strip()
+            desc = x.get('item').get('description').strip()
+            start = parse_bt_time(x.get('broadcast').get('transmission_time'))
+            end = parse_bt_time(x.get('broadcast').get('transmission_end_time'))
+            icon = x.get('item').get('image')
+            ch_name = channel.id
+
+            programmes.append(Programme(title=title, description=desc, start=start, stop=end, icon=icon,
+                                        channel=ch_name))
+
+    return programmes
+
+
+def get_html_parser() -> lhtml.HTMLParser:
+    """
+Get this thread's HTML parser, making it on first use
+    :return: The parser
+    """
+    parser = getattr(html_parsers, "parser", None)
+    if parser is None:
+        parser = html_parsers.parser = lhtml.HTMLParser()
+    return parser
+
+
+def parse_bbc_page(channel_id: str, current_date: date, content: bytes) -> list:
+    """
+Scrape the programmes from a BBC Sounds schedule page. This is CPU-bound, so it's run in parse_pool
+    :param channel_id: The XMLTV ID of the station
+    :param current_date: The date the schedule page is for
+    :param content: The page's HTML
+    :return: List of programmes
+    """
+    programmes = []
+    doc = lhtml.fromstring(content, parser=get_html_parser())
+
+    # Get the schedule sections (early, morning, afternoon, evening, late)
+    sections = bbc_section_selector(doc)
+    # Find each programme item as a block on the schedule, and get all of their air times up front so the next
+    # programme's start time is just a lookup
+    section_items = [bbc_item_selector(section) for section in sections]
+    air_times = [[datetime.strptime(bbc_air_time_selector(item)[0].text_content(), "%H:%M").time()
+                  for item in items] for items in section_items]
+    for s_idx, section in enumerate(sections):
+        programme_items = section_items[s_idx]
+        print(f"Total items in section {s_idx}: {len(programme_items)}")
+        for p_idx, item in enumerate(programme_items):
+            # Get the air time from the block. We only want shows from 00:00:00 to 23:59:59 for each page,
+            # so get rid of shows that start on the day before or day after
+            air_time = air_times[s_idx][p_idx]
+            if section.get("aria-labelledby") == "early":
+                if air_time >= time(7, 0, 0):
+                    continue
+            if section.get("aria-labelledby") == "late":
+                if air_time > time(0, 30, 0):
+                    continue
+
+            # Dive further into each item to extract info correctly
+            programme_thumbnail = item.find(".//img").get('src')
+            info = bbc_info_selector(item)[0][0]
+            programme_name = info[0].text_content()
+            programme_desc = info[2].text_content()
+            programme_start = datetime.combine(current_date, air_time)
+            if section.get("aria-labelledby") == "late":
+                if programme_start.time() > time(0, 30, 0):
+                    continue
+            ch_name = channel_id
+            # If we're still within the same section (as in, we haven't run out of programmes in the list), get
+            # the next programme's start time from the next item in the list
+            try:
+                if p_idx <= len(programme_items):
+                    next_idx = p_idx + 1
+                    next_start = air_times[s_idx][next_idx]
+            except IndexError as ex:
+                # However, if we have run out of programmes, but not run out of sections, then find the next
+                # start time from first programme block in the next section
+                if s_idx + 1 < len(sections):
+                    next_idx = s_idx + 1
+                    next_start = air_times[next_idx][0]
+
+            print(f"\nName: {programme_name}, Loc: S{s_idx}P{p_idx}")
+            if s_idx == 3 and p_idx == len(programme_items) - 1:
+                programme_stop = datetime.combine(programme_start.date() + timedelta(days=1), next_start)
+            elif s_idx == 4:
+                if len(programme_items) == 1 or p_idx == len(programme_items) - 1:
+                    continue
+                else:
+                    programme_start = datetime.combine(programme_start.date() + timedelta(days=1), air_time)
+                    programme_stop = datetime.combine(programme_start.date(), next_start)
+            else:
+                programme_stop = datetime.combine(programme_start, next_start)
+            print(f"On: {programme_start} - {programme_stop}\n")
+
+            programmes.append(Programme(title=programme_name, description=programme_desc,
+                                        start=programme_start.timestamp(), stop=programme_stop.timestamp(),
+                                        icon=programme_thumbnail, channel=ch_name))
+
+    return programmes
+
+
+async def fetch_bbc(session: aiohttp.ClientSession, channel: Channel, sem: asyncio.Semaphore) -> list:
+    """
+Get the programmes for a BBC radio station by scraping its BBC Sounds schedule pages
+    :param session: The shared HTTP session
+    :param channel: The channel to be fetched
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :return: List of programmes
+    """
+    programmes = []
+    url_list = [bbc_url_template.format(sid=channel.sid, date=d.date()) for d in get_days("bbc_radio")]
+    pages = await asyncio.gather(*(get_content(session, sem, url) for url in url_list))
+
+    # Now the pages have arrived, parse them in parallel
+    loop = asyncio.get_running_loop()
+    parses = []
+    for url, content in zip(url_list, pages):
+        current_date = datetime.strptime(url.split('/')[-1], "%Y-%m-%d").date()
+        if content is None:
+            continue
+        parses.append(loop.run_in_executor(parse_pool, parse_bbc_page, channel.id, current_date, content))
+
+    for result in await asyncio.gather(*parses):
+        programmes.extend(result)
+
+    return programmes
+
+
+def fetch_freeview_info(session: aiohttp.ClientSession, sem: asyncio.Semaphore, info_cache: dict, key: tuple,
+                        url: str) -> asyncio.Future:
+    """
+Get the in-depth information for a Freeview programme, only requesting each programme once. The same programme shows
+up in more than one day's listings, so requests are shared through info_cache
+    :param session: The shared HTTP session
+    :param sem: Semaphore limiting the number of requests in flight to Freeview
+    :param info_cache: In-flight or finished requests for this run, keyed by (service ID, network ID, programme ID)
+    :param key: The programme's (service ID, network ID, programme ID)
+    :param url: The programme information URL
+    :return: A future resolving to the decoded JSON, or None if it couldn't be retrieved
+    """
+    # Without a programme ID there's nothing to tell listings apart, so request them individually
+    if key[2] is None:
+        return asyncio.ensure_future(get_json(session, sem, url))
+
+    task = info_cache.get(key)
+    if task is None:
+        task = asyncio.ensure_future(get_json(session, sem, url))
+        info_cache[key] = task
+
+    return task
+
+
+async def fetch_freeview(session: aiohttp.ClientSession, channel: Channel, sem: asyncio.Semaphore,
+                         info_cache: dict = None) -> list:
+    """
+Get the programmes for a channel sourced from Freeview
+    :param session: The shared HTTP session
+    :param channel: The channel to be fetched
+    :param sem: Semaphore limiting the number of requests in flight to the source
+    :param info_cache: Programme information requests to share with other channels; see fetch_freeview_info
+    :return: List of programmes
+    """
+    if info_cache is None:
+        info_cache = {}
+    programmes = []
+    epoch_times = get_days("freeview")
+    # Get programme data for Freeview multiplex
+    params = [{'nid': channel.nid, 'start': str(epoch)} for epoch in epoch_times]
+    results = await asyncio.gather(*(get_json(session, sem, freeview_guide_url, params=p) for p in params))
+    for result in results:
+        if result is None:
+            continue
+        epg_data = result['data']['programs']
+
+        ch_match = filter(lambda ch: ch['service_id'] == channel.sid, epg_data)
+
+        # For each channel in result, get UID from JSON
+        for item in ch_match:
+            service_id = item.get('service_id')
+            listings = item.get('events')
+
+            # There's another URL for more in-depth programme information, so fetch it for every listing at once
+            info_results = await asyncio.gather(*(
+                fetch_freeview_info(session, sem, info_cache, (service_id, channel.nid, listing.get('program_id')),
+                                    freeview_info_url_template.format(
+                                        sid=service_id, nid=channel.nid, pid=listing.get('program_id'),
+                                        start_time=listing.get('start_time'), duration=listing.get('duration')))
+                for listing in listings))
+
+            # Freeview API returns basic info with EPG API call
+            for listing, res in zip(listings, info_results):
+                if res is None:
+                    continue
+
+                ch_name = channel.id
+                title = listing.get("main_title")
+                desc = listing.get("secondary_title") if "secondary_title" in listing else \
+                    "No further information..."
+                temp_start = parse_freeview_time(listing.get('start_time'))
+                duration = parse_duration(listing.get('duration'))
+                end = (temp_start + duration).timestamp()
+                start = temp_start.timestamp()
+
+                # Should only return one programme, so just get the first if one exists
+                info = res['data']['programs'][0] if 'programs' in res['data'] else {}
+
+                # Update the description with Freeview Play's medium option if available
+                desc = info.get('synopsis').get('medium') if 'synopsis' in info else ''
+
+                # Get Freeview Play's image, or use the fallback
+                if 'image_url' in info:
+                    icon = info.get('image_url') + '?w=800'
+                elif 'fallback_image_url' in listing:
+                    icon = listing.get('fallback_image_url') + '?w=800'
+                else:
+                    icon = None
+
+                print(f"Title: {title} @ {temp_start}")
+
+                programmes.append(Programme(title=title, description=desc, start=start, stop=end, icon=icon,
+                                            channel=ch_name))
+
+    return programmes
+
+
+# Fetcher for each channel source. Each takes (session, channel, semaphore) and returns a list of programmes
+source_handlers = {
+    "sky": fetch_sky,
+    "bt": fetch_bt,
+    "bbc_radio": fetch_bbc,
+    "freeview": fetch_freeview,
+}
+
+
+async def fetch_programmes(channels: list) -> list:
+    """
+Fetch the programmes for every channel concurrently
+    :param channels: The list of channels to be fetched
+    :return: List of programmes for all channels
+    """
+    sems = {src: asyncio.Semaphore(limit) for src, limit in source_limits.items()}
+    # One pooled session for the whole run, so connections (and their TLS handshakes) are reused between requests
+    connector = aiohttp.TCPConnector(limit=32, limit_per_host=max(source_limits.values()),
+                                     keepalive_timeout=keepalive_timeout, ttl_dns_cache=300)
+    async with aiohttp.ClientSession(connector=connector, headers=session_headers,
+                                     timeout=aiohttp.ClientTimeout(total=None, sock_connect=connect_timeout,
+                                                                   sock_read=read_timeout)) as session:
+        # Freeview programme information is shared between channels, but only for this run, as the cached tasks
+        # belong to this event loop
+        handlers = dict(source_handlers)
+        handlers["freeview"] = functools.partial(source_handlers["freeview"], info_cache={})
+
+        tasks = []
+        for channel in channels:
+            handler = handlers.get(channel.source)
+            if handler:
+                tasks.append(handler(session, channel, sems[channel.source]))
+        results = await asyncio.gather(*tasks)
+
+    return [programme for result in results for programme in result]
+
+
+if __name__ == "__main__":
+    # Load the channels data
+    channels_data = get_channels_data()
+
+    # Workers are started inside asyncio.run, once aiohttp's resolver threads exist, so spawn rather than fork them
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as parse_pool:
+        programme_data = asyncio.run(fetch_programmes(channels_data))
+
+    # Write some XML
+    write_xmltv('epg.xml', channels_data, programme_data)